@@ -5,18 +5,28 @@ import pytest
 import dbus
 import dbusmock
 import os
-import tempfile
 import subprocess
-import time
 import signal
 import json
+import copy
+import logging
+import xnmp
 from pathlib import Path
-from dbus.mainloop.glib import DBusGMainLoop
 
 
-def pytest_configure() -> None:
+logger = logging.getLogger(__name__)
+
+TEST_DIR = Path(__file__).resolve().parent
+NATIVE_MESSAGING_HOSTS_DIR = TEST_DIR / "native-messaging-hosts"
+
+
+def pytest_configure(config: pytest.Config) -> None:
     ensure_environment_set()
-    DBusGMainLoop(set_as_default=True)
+    config.addinivalue_line(
+        "markers",
+        "xnmp_isolated: run the test against its own xdg-native-messaging-proxy "
+        "instead of the one shared by the session",
+    )
 
 
 def pytest_sessionfinish(session, exitstatus):
@@ -26,6 +36,25 @@ def pytest_sessionfinish(session, exitstatus):
         session.exitstatus = 77
 
 
+_dbus_mainloop_set = False
+
+
+def ensure_dbus_mainloop() -> None:
+    """
+    Makes the GLib mainloop the default for dbus-python connections. Importing
+    GLib is deferred to here, so that collecting the tests doesn't load it.
+    """
+    global _dbus_mainloop_set
+
+    if _dbus_mainloop_set:
+        return
+
+    from dbus.mainloop.glib import DBusGMainLoop
+
+    DBusGMainLoop(set_as_default=True)
+    _dbus_mainloop_set = True
+
+
 def ensure_environment_set() -> None:
     env_vars = [
         "XDG_NATIVE_MESSAGING_PROXY_PATH",
@@ -36,29 +65,44 @@ def ensure_environment_set() -> None:
             raise Exception(f"{env_var} must be set")
 
 
-@pytest.fixture(autouse=True)
-def create_test_dirs() -> Iterator[None]:
+def create_env_dirs(root: Path) -> dict[str, str]:
     env_dirs = [
         "HOME",
         "TMPDIR",
     ]
 
-    test_root = tempfile.TemporaryDirectory(
-        prefix="xnmp-testroot-", ignore_cleanup_errors=True
-    )
-
+    env = {}
     for env_dir in env_dirs:
-        directory = Path(test_root.name) / env_dir.lower()
+        directory = root / env_dir.lower()
         directory.mkdir(mode=0o700, parents=True)
-        os.environ[env_dir] = directory.absolute().as_posix()
+        env[env_dir] = directory.absolute().as_posix()
+
+    return env
 
-    yield
 
-    test_root.cleanup()
+@pytest.fixture(autouse=True)
+def create_test_dirs(tmp_path_factory: pytest.TempPathFactory) -> dict[str, str]:
+    # Cleaned up by the retention policy of pytest, not after each test
+    test_root = tmp_path_factory.mktemp("xnmp-testroot")
 
+    env_dirs = create_env_dirs(test_root)
+    os.environ.update(env_dirs)
+    return env_dirs
+
+
+@pytest.fixture(scope="session")
+def xnmp_session_root(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    """
+    Root directory for everything the shared xdg-native-messaging-proxy of the
+    session uses.
+    """
+    return tmp_path_factory.mktemp("xnmp-sessionroot")
+
+
+@pytest.fixture(scope="session")
+def dbus_session() -> Iterator[dbusmock.DBusTestCase]:
+    ensure_dbus_mainloop()
 
-@pytest.fixture
-def create_test_dbus() -> Iterator[dbusmock.DBusTestCase]:
     bus = dbusmock.DBusTestCase()
     bus.setUp()
     bus.start_session_bus()
@@ -71,22 +115,52 @@ def create_test_dbus() -> Iterator[dbusmock.DBusTestCase]:
 
 
 @pytest.fixture
-def dbus_con(create_test_dbus: dbusmock.DBusTestCase) -> dbus.Bus:
+def create_test_dbus(dbus_session: dbusmock.DBusTestCase) -> dbusmock.DBusTestCase:
+    """
+    The session and system bus are shared by all tests of the session.
+    """
+    return dbus_session
+
+
+@pytest.fixture
+def dbus_con(create_test_dbus: dbusmock.DBusTestCase) -> Iterator[dbus.Bus]:
     """
     Default fixture which provides the python-dbus session bus of the test.
+
+    This is a private connection to the shared session bus. Closing it at the
+    end of the test makes the proxy clean up everything the test started.
     """
     con = create_test_dbus.get_dbus(system_bus=False)
     assert con
-    return con
 
+    yield con
 
-@pytest.fixture(autouse=True)
-def create_dbus_monitor(create_test_dbus) -> Iterator[subprocess.Popen | None]:
+    if con.get_is_connected():
+        con.close()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def create_dbus_monitor(
+    dbus_session: dbusmock.DBusTestCase,
+    tmp_path_factory: pytest.TempPathFactory,
+) -> Iterator[subprocess.Popen | None]:
+    """
+    Records the traffic on the session bus of the whole session if
+    XNMP_DBUS_MONITOR is set.
+    """
     if not os.getenv("XNMP_DBUS_MONITOR"):
         yield None
         return
 
-    dbus_monitor = subprocess.Popen(["dbus-monitor", "--session"])
+    log_path = tmp_path_factory.mktemp("dbus-monitor") / "dbus-monitor.log"
+    logger.info(f"Writing dbus-monitor output to {log_path}")
+
+    with open(log_path, "wb") as log:
+        dbus_monitor = subprocess.Popen(
+            ["dbus-monitor", "--session"],
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
 
     yield dbus_monitor
 
@@ -94,91 +168,399 @@ def create_dbus_monitor(create_test_dbus) -> Iterator[subprocess.Popen | None]:
     dbus_monitor.wait()
 
 
-def test_dir() -> Path:
-    return Path(__file__).resolve().parent
+def default_xnmp_host_locations(env_dirs: dict[str, str]) -> Path:
+    return Path(env_dirs["TMPDIR"]) / "native-messaging-hosts"
 
 
 @pytest.fixture
-def xnmp_host_locations(create_test_dirs) -> Path | None:
-    return Path(os.environ["TMPDIR"]) / "native-messaging-hosts"
+def xnmp_host_locations(create_test_dirs: dict[str, str]) -> Path | None:
+    """
+    Overriding this fixture with other host locations makes the test run
+    against its own xdg-native-messaging-proxy.
+    """
+    return default_xnmp_host_locations(create_test_dirs)
 
 
-@pytest.fixture(autouse=True)
-def manifests(xnmp_host_locations):
-    nmhd = test_dir() / "native-messaging-hosts"
+@pytest.fixture(scope="session")
+def xnmp_session_host_locations(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    return tmp_path_factory.mktemp("native-messaging-hosts")
+
+
+@pytest.fixture(scope="session")
+def session_manifests(xnmp_session_host_locations: Path) -> dict[str, dict]:
+    """
+    The manifests of the test hosts with relative paths made absolute. They get
+    rendered into xnmp_session_host_locations once per session.
+    """
+    nmhd = os.fspath(NATIVE_MESSAGING_HOSTS_DIR)
+    destination_dir = os.fspath(xnmp_session_host_locations)
     manifests = {}
 
-    xnmp_host_locations.mkdir(parents=True)
+    with os.scandir(nmhd) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".json"):
+                continue
+
+            manifest_name = entry.name.removesuffix(".json")
+
+            with open(entry.path, "rb") as f:
+                manifest = json.load(f)
 
-    for manifest_path in nmhd.glob("*.json"):
-        manifest = json.loads(manifest_path.read_text())
+            assert manifest["name"] == manifest_name
 
-        assert manifest["name"] == manifest_path.stem
+            destination = os.path.join(destination_dir, entry.name)
+            manifests[manifest_name] = manifest
 
-        path = manifest["path"]
-        if path[0] != "/":
-            manifest["path"] = (nmhd / path).absolute().as_posix()
+            # Manifests with an absolute path can be used as they are
+            path = manifest["path"]
+            if path[0] == "/":
+                os.symlink(entry.path, destination)
+                continue
 
-        destination = xnmp_host_locations / manifest_path.name
-        destination.write_text(json.dumps(manifest))
-        manifests[manifest_path.stem] = manifest
+            # TEST_DIR is already absolute
+            manifest["path"] = os.path.join(nmhd, path)
+
+            with open(destination, "wb") as f:
+                f.write(json.dumps(manifest).encode())
 
     return manifests
 
 
 @pytest.fixture
+def manifests(session_manifests: dict[str, dict]) -> dict[str, dict]:
+    """
+    The manifests of the test hosts. A copy, so that tests can't change them for
+    the tests which come after.
+    """
+    return copy.deepcopy(session_manifests)
+
+
+def link_manifests(
+    xnmp_host_locations: Path,
+    xnmp_session_host_locations: Path,
+    session_manifests: dict[str, dict],
+) -> None:
+    """
+    Links the manifests rendered for the session into xnmp_host_locations,
+    unless there already is a manifest with the same name.
+    """
+    xnmp_host_locations.mkdir(parents=True, exist_ok=True)
+
+    for manifest_name in session_manifests:
+        filename = f"{manifest_name}.json"
+        destination = xnmp_host_locations / filename
+        if not destination.exists():
+            destination.symlink_to(xnmp_session_host_locations / filename)
+
+
+@pytest.fixture(scope="session")
 def xdg_native_messaging_proxy_path() -> Path:
     return Path(os.environ["XDG_NATIVE_MESSAGING_PROXY_PATH"])
 
 
 @pytest.fixture
 def xnmp_overwrite_env() -> dict[str, str]:
+    """
+    Overriding this fixture with environment variables which change the
+    environment makes the test run against its own xdg-native-messaging-proxy.
+    """
     return {}
 
 
-@pytest.fixture
-def xnmp_env(
-    xnmp_overwrite_env: dict[str, str],
-    xnmp_host_locations: Path | None,
-) -> dict[str, str]:
+@pytest.fixture(scope="session")
+def xnmp_base_env(dbus_session: dbusmock.DBusTestCase) -> dict[str, str]:
+    """
+    The part of the proxy environment which is the same for all tests. Copying
+    os.environ is only done once per session.
+    """
     env = os.environ.copy()
     env["G_DEBUG"] = "fatal-criticals"
     env["G_MESSAGES_DEBUG"] = "all"
     env["XDG_CURRENT_DESKTOP"] = "test"
 
+    return env
+
+
+def create_xnmp_env(
+    xnmp_base_env: dict[str, str],
+    env_dirs: dict[str, str],
+    xnmp_overwrite_env: dict[str, str],
+    xnmp_host_locations: Path | None,
+) -> dict[str, str]:
+    env = xnmp_base_env | env_dirs
+
     if xnmp_host_locations:
         env["XNMP_HOST_LOCATIONS"] = xnmp_host_locations.absolute().as_posix()
 
-    for key, val in xnmp_overwrite_env.items():
-        env[key] = val
+    env |= xnmp_overwrite_env
 
     return env
 
 
 @pytest.fixture
-def xdg_native_messaging_proxy(
+def xnmp_env(
+    xnmp_base_env: dict[str, str],
+    create_test_dirs: dict[str, str],
+    xnmp_overwrite_env: dict[str, str],
+    xnmp_host_locations: Path | None,
+) -> dict[str, str]:
+    """
+    The environment of the xdg-native-messaging-proxy. Overriding this fixture
+    with a different environment makes the test run against its own proxy.
+    """
+    return create_xnmp_env(
+        xnmp_base_env,
+        create_test_dirs,
+        xnmp_overwrite_env,
+        xnmp_host_locations,
+    )
+
+
+@pytest.fixture(scope="session")
+def xnmp_session_env(
+    xnmp_base_env: dict[str, str],
+    xnmp_session_root: Path,
+    xnmp_session_host_locations: Path,
+    session_manifests: dict[str, dict],
+) -> dict[str, str]:
+    return create_xnmp_env(
+        xnmp_base_env,
+        create_env_dirs(xnmp_session_root),
+        {},
+        xnmp_session_host_locations,
+    )
+
+
+def add_name_owner_changed_receiver(
+    dbus_con: dbus.Bus,
+    handler_function,
+) -> dbus.connection.SignalMatch:
+    return dbus_con.add_signal_receiver(
+        handler_function,
+        signal_name="NameOwnerChanged",
+        dbus_interface="org.freedesktop.DBus",
+        arg0=xnmp.XNMP_BUS_NAME,
+    )
+
+
+def start_xdg_native_messaging_proxy(
     dbus_con: dbus.Bus,
     xdg_native_messaging_proxy_path: Path,
     xnmp_env: dict[str, str],
-) -> Iterator[subprocess.Popen]:
+) -> subprocess.Popen:
     if not xdg_native_messaging_proxy_path.exists():
         raise FileNotFoundError(f"{xdg_native_messaging_proxy_path} does not exist")
 
+    from gi.repository import GLib
+
+    name_owned = False
+    returncode = None
+
+    def on_name_owner_changed(name, old_owner, new_owner):
+        nonlocal name_owned
+        if new_owner:
+            name_owned = True
+
+    def on_exited(pid, wait_status):
+        nonlocal returncode
+        returncode = os.waitstatus_to_exitcode(wait_status)
+
+    match = add_name_owner_changed_receiver(dbus_con, on_name_owner_changed)
+
+    # The own session keeps terminal signals meant for pytest away from the
+    # proxy, which only gets stopped with SIGHUP
     xdg_native_messaging_proxy = subprocess.Popen(
         [xdg_native_messaging_proxy_path],
         env=xnmp_env,
+        start_new_session=True,
     )
 
-    while not dbus_con.name_has_owner("org.freedesktop.NativeMessagingProxy"):
-        returncode = xdg_native_messaging_proxy.poll()
-        if returncode is not None:
-            raise subprocess.SubprocessError(
-                f"xdg-native-messaging-proxy exited with {returncode}"
-            )
-        time.sleep(0.1)
+    child_watch_id = GLib.child_watch_add(
+        GLib.PRIORITY_DEFAULT,
+        xdg_native_messaging_proxy.pid,
+        on_exited,
+    )
 
-    yield xdg_native_messaging_proxy
+    try:
+        xnmp.wait_for(lambda: name_owned or returncode is not None)
+    except TimeoutError:
+        # Don't let GLib reap the process behind the back of Popen
+        GLib.source_remove(child_watch_id)
+        xdg_native_messaging_proxy.kill()
+        xdg_native_messaging_proxy.wait()
+        raise
+    finally:
+        match.remove()
+
+    if returncode is not None:
+        raise subprocess.SubprocessError(
+            f"xdg-native-messaging-proxy exited with {returncode}"
+        )
+
+    # The child watch would reap the process, which is left to Popen
+    GLib.source_remove(child_watch_id)
+
+    return xdg_native_messaging_proxy
+
+
+def stop_xdg_native_messaging_proxy(
+    dbus_con: dbus.Bus,
+    xdg_native_messaging_proxy: subprocess.Popen,
+) -> None:
+    name_released = False
+
+    def on_name_owner_changed(name, old_owner, new_owner):
+        nonlocal name_released
+        if not new_owner:
+            name_released = True
+
+    match = add_name_owner_changed_receiver(dbus_con, on_name_owner_changed)
 
     xdg_native_messaging_proxy.send_signal(signal.SIGHUP)
     returncode = xdg_native_messaging_proxy.wait()
     assert returncode == 0
+
+    # Another proxy can only own the name once the bus noticed it is gone
+    try:
+        if dbus_con.name_has_owner(xnmp.XNMP_BUS_NAME):
+            xnmp.wait_for(lambda: name_released)
+    finally:
+        match.remove()
+
+
+class SharedXdgNativeMessagingProxy:
+    """
+    An xdg-native-messaging-proxy which is shared by all tests of the session.
+    It gets started on first use, stopped while a test runs against its own
+    proxy, and restarted if it died.
+    """
+
+    def __init__(
+        self,
+        dbus_con: dbus.Bus,
+        xdg_native_messaging_proxy_path: Path,
+        xnmp_env: dict[str, str],
+    ) -> None:
+        self.dbus_con = dbus_con
+        self.xdg_native_messaging_proxy_path = xdg_native_messaging_proxy_path
+        self.xnmp_env = xnmp_env
+        self.xdg_native_messaging_proxy: subprocess.Popen | None = None
+
+    def get(self) -> subprocess.Popen:
+        # A crash has already been reported by the test it happened in
+        if self.xdg_native_messaging_proxy is not None:
+            if self.xdg_native_messaging_proxy.poll() is not None:
+                self.xdg_native_messaging_proxy = None
+
+        if self.xdg_native_messaging_proxy is None:
+            self.xdg_native_messaging_proxy = start_xdg_native_messaging_proxy(
+                self.dbus_con,
+                self.xdg_native_messaging_proxy_path,
+                self.xnmp_env,
+            )
+
+        return self.xdg_native_messaging_proxy
+
+    def stop(self) -> None:
+        if self.xdg_native_messaging_proxy is not None:
+            if self.xdg_native_messaging_proxy.poll() is not None:
+                self.xdg_native_messaging_proxy = None
+                return
+
+            stop_xdg_native_messaging_proxy(
+                self.dbus_con,
+                self.xdg_native_messaging_proxy,
+            )
+            self.xdg_native_messaging_proxy = None
+
+
+@pytest.fixture(scope="session")
+def xnmp_session_proxy(
+    dbus_session: dbusmock.DBusTestCase,
+    xdg_native_messaging_proxy_path: Path,
+    xnmp_session_env: dict[str, str],
+) -> Iterator[SharedXdgNativeMessagingProxy]:
+    con = dbus_session.get_dbus(system_bus=False)
+    shared_proxy = SharedXdgNativeMessagingProxy(
+        con,
+        xdg_native_messaging_proxy_path,
+        xnmp_session_env,
+    )
+
+    yield shared_proxy
+
+    shared_proxy.stop()
+    con.close()
+
+
+@pytest.fixture
+def xdg_native_messaging_proxy(
+    request: pytest.FixtureRequest,
+    xnmp_session_proxy: SharedXdgNativeMessagingProxy,
+    dbus_con: dbus.Bus,
+    xdg_native_messaging_proxy_path: Path,
+    xnmp_base_env: dict[str, str],
+    create_test_dirs: dict[str, str],
+    xnmp_env: dict[str, str],
+    xnmp_host_locations: Path | None,
+    xnmp_session_host_locations: Path,
+    session_manifests: dict[str, dict],
+) -> Iterator[subprocess.Popen]:
+    """
+    The xdg-native-messaging-proxy the test talks to. This is the proxy shared
+    by the session, unless the test is marked with xnmp_isolated or changes the
+    environment of the proxy.
+    """
+    # Catches overrides of xnmp_env, xnmp_overwrite_env and xnmp_host_locations
+    default_env = create_xnmp_env(
+        xnmp_base_env,
+        create_test_dirs,
+        {},
+        default_xnmp_host_locations(create_test_dirs),
+    )
+    isolated = request.node.get_closest_marker("xnmp_isolated") is not None
+
+    if xnmp_env == default_env and not isolated:
+        xdg_native_messaging_proxy = xnmp_session_proxy.get()
+
+        yield xdg_native_messaging_proxy
+
+        # Report a proxy which crashed or aborted in the test which caused it
+        returncode = xdg_native_messaging_proxy.poll()
+        assert (
+            returncode is None
+        ), f"xdg-native-messaging-proxy exited with {returncode}"
+        return
+
+    # Unlike the shared proxy, this one reads the manifests from
+    # xnmp_host_locations
+    if xnmp_host_locations is not None:
+        link_manifests(
+            xnmp_host_locations,
+            xnmp_session_host_locations,
+            session_manifests,
+        )
+
+    # Only one proxy at a time can own the bus name
+    xnmp_session_proxy.stop()
+
+    xdg_native_messaging_proxy = start_xdg_native_messaging_proxy(
+        dbus_con,
+        xdg_native_messaging_proxy_path,
+        xnmp_env,
+    )
+
+    yield xdg_native_messaging_proxy
+
+    stop_xdg_native_messaging_proxy(dbus_con, xdg_native_messaging_proxy)
+
+
+@pytest.fixture
+def iface(
+    xdg_native_messaging_proxy: subprocess.Popen,
+    dbus_con: dbus.Bus,
+) -> dbus.Interface:
+    """
+    The NativeMessagingProxy interface of the proxy the test talks to.
+    """
+    return xnmp.get_iface(dbus_con)
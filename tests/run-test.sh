@@ -5,6 +5,9 @@
 #   the source tree
 # - The BUILDDIR environment variable can be set to a specific build directory
 # - All arguments are passed along to pytest
+# - The XNMP_TEST_JOBS environment variable can be set to run the tests in
+#   parallel with pytest-xdist (e.g. XNMP_TEST_JOBS=auto). The output of the
+#   proxy does not show up in the test log then, because xdist workers drop it.
 #
 # Examples:
 #
@@ -33,4 +36,11 @@ echo ""
 
 export XDG_NATIVE_MESSAGING_PROXY_PATH="$BUILDDIR/src/xdg-native-messaging-proxy"
 
-exec "$PYTEST" "$@"
+PYTEST_ARGS=()
+if [ -n "${XNMP_TEST_JOBS:-}" ]; then
+  # grep has to consume all of the output, pipefail would catch a SIGPIPE
+  "$PYTEST" --help | grep -- "--numprocesses" >/dev/null || fail "pytest-xdist is missing"
+  PYTEST_ARGS+=(-n "$XNMP_TEST_JOBS")
+fi
+
+exec "$PYTEST" ${PYTEST_ARGS[@]+"${PYTEST_ARGS[@]}"} "$@"
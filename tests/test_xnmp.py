@@ -1,37 +1,38 @@
 import os
+import contextlib
+import select
 import json
 import xnmp
-import errno
+import pytest
 from pathlib import Path
 
 
 class TestXnmp:
-    def test_cat(self, xdg_native_messaging_proxy, manifests, dbus_con):
-        iface = xnmp.get_iface(dbus_con)
+    @pytest.mark.parametrize(
+        "manifest_name",
+        [
+            "org.example.cat",
+            "org.example.echo",
+            "org.example.writeonclose",
+        ],
+    )
+    def test_get_manifest(self, iface, manifests, manifest_name):
+        mode = "firefox"
+
+        manifest_str = iface.GetManifest(manifest_name, mode, {})
+        assert json.loads(manifest_str) == manifests[manifest_name]
+
+    def test_cat(self, iface, manifests):
         manifest_name = "org.example.cat"
         manifest = manifests[manifest_name]
         extension = "some-extension@example.org"
         mode = "firefox"
 
-        manifest_str = iface.GetManifest(manifest_name, mode, {})
-        assert json.loads(manifest_str) == manifest
-
         (stdin, stdout, stderr, handle) = iface.Start(
             manifest_name, extension, mode, {}
         )
 
-        closed_received = False
-
-        def on_closed(closed_handle, options):
-            nonlocal closed_received
-            nonlocal handle
-
-            assert closed_handle == handle
-            closed_received = True
-
-        iface.connect_to_signal("Closed", on_closed)
-
-        xnmp.wait_for(lambda: closed_received)
+        xnmp.wait_for_closed(iface, handle)
 
         stdout_fd = stdout.take()
         try:
@@ -40,34 +41,41 @@ class TestXnmp:
         finally:
             os.close(stdout_fd)
 
-    def test_echo(self, xdg_native_messaging_proxy, manifests, dbus_con):
-        iface = xnmp.get_iface(dbus_con)
+    def test_echo(self, iface, manifests):
         manifest_name = "org.example.echo"
-        manifest = manifests[manifest_name]
         extension = "some-extension@example.org"
         mode = "firefox"
 
-        manifest_str = iface.GetManifest(manifest_name, mode, {})
-        assert json.loads(manifest_str) == manifest
-
         (stdin, stdout, stderr, handle) = iface.Start(
             manifest_name, extension, mode, {}
         )
 
-        stdout_fd = stdout.take()
-        stdin_fd = stdin.take()
-        try:
+        with contextlib.ExitStack() as stack:
+            stdout_fd = stdout.take()
+            stack.callback(os.close, stdout_fd)
+            stdin_fd = stdin.take()
+            stack.callback(os.close, stdin_fd)
+
             msg = b"this is a test"
             os.write(stdin_fd, msg)
-            result = os.read(stdout_fd, 1024)
+
+            result = b""
+            while len(result) < len(msg):
+                xnmp.wait_for_fd(stdout_fd, select.POLLIN)
+                data = os.read(stdout_fd, 1024)
+                assert data, "Unexpected end of stdout"
+                result += data
+
             assert result == msg
-        finally:
-            os.close(stdout_fd)
-            os.close(stdin_fd)
 
-    def test_close(self, xdg_native_messaging_proxy, manifests, dbus_con):
-        iface = xnmp.get_iface(dbus_con)
-        manifest_name = "org.example.echo"
+    @pytest.mark.parametrize(
+        "manifest_name",
+        [
+            "org.example.echo",
+            "org.example.writeonclose",
+        ],
+    )
+    def test_close(self, iface, manifests, manifest_name):
         extension = "some-extension@example.org"
         mode = "firefox"
 
@@ -77,21 +85,9 @@ class TestXnmp:
 
         iface.Close(handle, {})
 
-        closed_received = False
+        xnmp.wait_for_closed(iface, handle)
 
-        def on_closed(closed_handle, options):
-            nonlocal closed_received
-            nonlocal handle
-
-            assert closed_handle == handle
-            closed_received = True
-
-        iface.connect_to_signal("Closed", on_closed)
-
-        xnmp.wait_for(lambda: closed_received)
-
-    def test_dbus_close(self, xdg_native_messaging_proxy, manifests, dbus_con):
-        iface = xnmp.get_iface(dbus_con)
+    def test_dbus_close(self, iface, manifests, dbus_con):
         manifest_name = "org.example.echo"
         extension = "some-extension@example.org"
         mode = "firefox"
@@ -103,24 +99,19 @@ class TestXnmp:
         dbus_con.close()
 
         stdin_fd = stdin.take()
-
-        def fd_closed():
-            try:
-                msg = b"1"
-                os.write(stdin_fd, msg)
-            except IOError as e:
-                return e.errno == errno.EPIPE
-            except Exception:
-                return False
-            return False
-
         try:
-            xnmp.wait_for(fd_closed)
+            events = xnmp.wait_for_fd(stdin_fd)
+            assert events & select.POLLERR
+
+            with pytest.raises(BrokenPipeError):
+                os.write(stdin_fd, b"1")
         finally:
             os.close(stdin_fd)
 
-    def test_close_stdin(self, xdg_native_messaging_proxy, manifests, dbus_con):
-        iface = xnmp.get_iface(dbus_con)
+    # The host writes into the TMPDIR of the proxy, which has to be the one of
+    # the test
+    @pytest.mark.xnmp_isolated
+    def test_close_stdin(self, iface, manifests):
         manifest_name = "org.example.writeonclose"
         extension = "some-extension@example.org"
         mode = "firefox"
@@ -135,4 +126,4 @@ class TestXnmp:
         stdin_fd = stdin.take()
 
         os.close(stdin_fd)
-        xnmp.wait_for(lambda: fpath.exists())
+        xnmp.wait_for_path(fpath)
@@ -1,21 +1,29 @@
 from typing import Callable
-from gi.repository import GLib
+from pathlib import Path
+import select
 import dbus
 
 
+XNMP_BUS_NAME = "org.freedesktop.NativeMessagingProxy"
+WAIT_TIMEOUT_MS = 5000
+
+
 def wait(ms: int):
     """
     Waits for the specified amount of milliseconds.
     """
+    from gi.repository import GLib
+
     mainloop = GLib.MainLoop()
     GLib.timeout_add(ms, mainloop.quit)
     mainloop.run()
 
 
-def wait_for(fn: Callable[[], bool]):
+def wait_for(fn: Callable[[], bool], timeout_ms: int = WAIT_TIMEOUT_MS):
     """
-    Waits and dispatches to mainloop until the function fn returns true. This is
-    useful in combination with a lambda which captures a variable:
+    Waits and dispatches to mainloop until the function fn returns true, or
+    raises TimeoutError after timeout_ms. This is useful in combination with a
+    lambda which captures a variable:
 
         my_var = False
         def callback():
@@ -23,16 +31,90 @@ def wait_for(fn: Callable[[], bool]):
         do_something_later(callback)
         xdp.wait_for(lambda: my_var)
     """
-    mainloop = GLib.MainLoop()
-    while not fn():
-        GLib.timeout_add(50, mainloop.quit)
-        mainloop.run()
+    from gi.repository import GLib
+
+    if fn():
+        return
+
+    context = GLib.MainContext.default()
+    timed_out = False
+
+    def on_timeout():
+        nonlocal timed_out
+        timed_out = True
+        return GLib.SOURCE_REMOVE
+
+    # Also makes sure the blocking iteration returns once the time is up
+    timeout_id = GLib.timeout_add(timeout_ms, on_timeout)
+
+    while not fn() and not timed_out:
+        context.iteration(True)
+
+    if not timed_out:
+        GLib.source_remove(timeout_id)
+
+    if not fn():
+        raise TimeoutError(f"Condition not met after {timeout_ms}ms")
+
+
+def wait_for_closed(iface: dbus.Interface, handle: str):
+    """
+    Waits until the Closed signal for handle gets emitted.
+    """
+    closed_received = False
+
+    def on_closed(closed_handle, options):
+        nonlocal closed_received
+
+        if closed_handle == handle:
+            closed_received = True
+
+    match = iface.connect_to_signal("Closed", on_closed)
+    try:
+        wait_for(lambda: closed_received)
+    finally:
+        match.remove()
+
+
+def wait_for_path(path: Path):
+    """
+    Waits until a file at path exists.
+    """
+    from gi.repository import Gio
+
+    # Dispatching the monitor events is enough to wake up the wait
+    monitor = Gio.File.new_for_path(path.as_posix()).monitor_file(
+        Gio.FileMonitorFlags.NONE, None
+    )
+    try:
+        wait_for(lambda: path.exists())
+    finally:
+        monitor.cancel()
+
+
+def wait_for_fd(fd: int, events: int = 0, timeout_ms: int = WAIT_TIMEOUT_MS) -> int:
+    """
+    Blocks until one of the poll events (select.POLLIN, ...) happens on fd and
+    returns the events which happened. POLLHUP and POLLERR are always reported,
+    so with the default of no events this waits until the other end of a pipe
+    got closed.
+
+    Raises TimeoutError if nothing happens within timeout_ms.
+    """
+    poller = select.poll()
+    poller.register(fd, events)
+
+    ready = poller.poll(timeout_ms)
+    if not ready:
+        raise TimeoutError(f"Nothing happened on fd {fd} after {timeout_ms}ms")
+
+    return ready[0][1]
 
 
 def get_iface(dbus_con: dbus.Bus) -> dbus.Interface:
     return dbus.Interface(
         dbus_con.get_object(
-            "org.freedesktop.NativeMessagingProxy",
+            XNMP_BUS_NAME,
             "/org/freedesktop/nativemessagingproxy",
         ),
         dbus_interface="org.freedesktop.NativeMessagingProxy",